@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 
 from collections import Counter
-from itertools import combinations
+from contextlib import nullcontext
+from functools import partial
+from itertools import chain, groupby
+from multiprocessing import Pool
 import numpy as np
-import networkx as nx
-from irescue.misc import get_ranges, getlen, writerr, run_shell_cmd
-from irescue.network import build_substr_idx, gen_ec_pairs
+from irescue.misc import getlen, writerr, run_shell_cmd, igzip, gzip_cmds
+from irescue.network import build_graph, connected_components
 from irescue.em import run_em
 import gzip
 import os
 
+# Approximate size in bytes of the blocks of mappings processed by each
+# count task.
+MAPS_BLOCK_SIZE = 2 ** 22
+
 class EquivalenceClass:
     def __init__(
             self,
@@ -24,121 +30,161 @@ class EquivalenceClass:
         self.count = count
     def to_tuple(self):
         return (self.umi, self.features, self.count)
-    def hdist(self, umi):
-        return sum(1 for i, j in zip(self.umi, umi) if i != j)
-    def connect(self, eqc, threshold):
-        return (self.count >= (2 * eqc.count) - 1
-                and self.features.intersection(eqc.features)
-                and self.hdist(eqc.umi) <= threshold)
 
-def pathfinder(graph, node, path=[], features=None):
+def pathfinder(indptr, indices, features, node, visited):
     """
     Finds first valid path of UMIs with compatible equivalence class given
     a starting node. Can be used iteratively to find all possible paths.
+
+    Parameters
+    ----------
+    indptr, indices : array
+        UMI graph adjacency in CSR format.
+    features : list
+        Set of features of each node.
+    node : int
+        Starting node of the path.
+    visited : array
+        Boolean mask of the nodes already used in a path, that will be
+        skipped. Updated in place with the nodes of the returned path.
+
+    Returns
+    -------
+    out : list
+        Nodes in the path, in depth-first order.
     """
-    if not features:
-        features = graph.nodes[node]['ft']
-    path += [node]
-    for next_node in graph.successors(node):
-        if (features.intersection(graph.nodes[next_node]['ft'])
-            and next_node not in path):
-            path = pathfinder(graph, next_node, path, features)
+    root_features = features[node]
+    path = [node]
+    visited[node] = True
+    # stack of (node, index of its next successor to visit)
+    stack = [(node, indptr[node])]
+    while stack:
+        current, i = stack.pop()
+        end = indptr[current + 1]
+        while i < end:
+            next_node = indices[i]
+            i += 1
+            if (not visited[next_node]
+                    and not root_features.isdisjoint(features[next_node])):
+                visited[next_node] = True
+                path.append(next_node)
+                stack.append((current, i))
+                stack.append((next_node, indptr[next_node]))
+                break
     return path
 
 def index_features(features_file):
     idx = {}
-    with gzip.open(features_file, 'rb') as f:
+    with igzip.open(features_file, 'rb') as f:
         for i, line in enumerate(f, start=1):
             ft = line.strip().split(b'\t')[0]
             idx[ft] = i
     return idx
 
-def parse_maps(maps_file, feature_index):
+def read_maps(maps_file, size=MAPS_BLOCK_SIZE):
     """
+    Read the mappings file in blocks of whole lines, without splitting the
+    mappings of a cell across blocks.
+
     maps_file : str
-        Content: "CB UMI FEATs count"
+        Content: "CB UMI FEATs count", sorted by CB.
+    size : int
+        Approximate size of blocks, in bytes.
+    out : bytes
+        Block of lines.
+    """
+    with igzip.open(maps_file, 'rb') as f:
+        rest = b''
+        for data in iter(partial(f.read, size), b''):
+            data = rest + data
+            # barcode of the last whole line, whose cell may continue in the
+            # next block
+            end = data.rfind(b'\n')
+            start = data.rfind(b'\n', 0, end) + 1
+            cb = data[start:data.find(b'\t', start)] + b'\t'
+            # cut the block before the first line of that cell
+            cut = 0 if data.startswith(cb) else data.find(b'\n' + cb) + 1
+            if end < 0 or cut == 0:
+                rest = data
+                continue
+            yield data[:cut]
+            rest = data[cut:]
+        if rest:
+            yield rest
+
+def parse_maps(block):
+    """
+    block : bytes
+        Content: "CB UMI FEATs count", as returned by read_maps().
     out : bytes, list
-        CB,
-        [(UMI <str>, {FT <int>, ...} <set>, count <int>) <tuple>, ...]
+        CB, [line <bytes>, ...]
+    """
+    lines = block.splitlines()
+    for cb, lines in groupby(lines, key=lambda x: x.split(b'\t', 1)[0]):
+        yield cb, list(lines)
+
+def get_equivalence_classes(lines, feature_index):
+    """
+    lines : list
+        Mappings of a single cell, as returned by parse_maps().
+    out : list
+        [EquivalenceClass(index, UMI, {FT <int>, ...}, count), ...]
     """
-    with gzip.open(maps_file, 'rb') as f:
-        cb, umi, feat, count = f.readline().strip().split(b'\t')
-        i = 0
-        it = cb
+    eqcl = []
+    for i, line in enumerate(lines):
+        cb, umi, feat, count = line.strip().split(b'\t')
         count = int(count)
         feat = {feature_index[ft] for ft in feat.split(b',')}
-        eqcl = [EquivalenceClass(i, umi, feat, count)]
-        for line in f:
-            cb, umi, feat, count = line.strip().split(b'\t')
-            count = int(count)
-            feat = {feature_index[ft] for ft in feat.split(b',')}
-            if cb == it:
-                i += 1
-                eqcl.append(EquivalenceClass(i, umi, feat, count))
-            else:
-                yield it, eqcl
-                it = cb
-                i = 0
-                eqcl = [EquivalenceClass(i, umi, feat, count)]
-        yield it, eqcl
+        eqcl.append(EquivalenceClass(i, umi, feat, count))
+    return eqcl
 
-def compute_cell_counts(equivalence_classes, features_index, max_iters,
-                        tolerance, dumpEC):
+def deduplicate(equivalence_classes):
     """
-    Calculate TE counts of a single cell, given a list of equivalence classes.
+    Collapse the UMIs of a single cell, given a list of equivalence classes.
+
+    Nodes of each subgraph are visited in ascending order, both as candidate
+    parents and as starting nodes of paths. Paths are found greedily, so this
+    order determines the path configurations, hence the number of
+    deduplicated UMIs of the cell: the totals of some cells can differ from
+    earlier versions, which followed the iteration order of networkx. Ties
+    between path configurations with the same number of paths are resolved
+    in favour of the one starting from the lowest parent node.
 
     Parameters
     ----------
     equivalence_classes : list
-        (UMI_sequence, {TE_index}, read_count) : (str, set, int)
-        Tuples containing UMI-TEs equivalence class infos.
+        EquivalenceClass objects of a single cell, sorted by index.
 
-    Returns
-    -------
-    out : dict
-        feature <int>: count <float> dictionary.
+    Yields
+    ------
+    path_config : list
+        Paths of nodes of a subgraph of connected nodes, each one collapsing
+        to a single deduplicated UMI and starting from its parent node.
+    features : list
+        Features assigned to each path.
     """
-    # initialize TE counts and dedup log
-    counts = Counter()
-    dump = None
-    number_of_features = len(features_index)
+    node_features = [x.features for x in equivalence_classes]
     # build cell-wide UMI deduplication graph
-    graph = nx.DiGraph()
-    # add nodes with annotated features
-    graph.add_nodes_from(
-        [(x.index, {'ft': x.features, 'c': x.count})
-        for x in equivalence_classes]
-    )
-    # make an iterator of umi pairs
-    if len(equivalence_classes) > 25:
-        umi_length = len(equivalence_classes[0].umi)
-        substr_idx = build_substr_idx(equivalence_classes, umi_length, 1)
-        iter_ec_pairs = gen_ec_pairs(equivalence_classes, substr_idx)
-    else:
-        iter_ec_pairs = combinations(equivalence_classes, 2)
-    for x, y in iter_ec_pairs:
-        # add edges to graph
-        if x.connect(y, 1):
-            graph.add_edge(x.index, y.index)
-        if y.connect(x, 1):
-            graph.add_edge(y.index, x.index)
-    if dumpEC:
-        # collect graph metadata in a dictionary
-        dump = {i: equivalence_classes[i].to_tuple() for i in graph.nodes}
+    indptr, indices = build_graph(equivalence_classes, threshold=1)
+    # number of predecessors of each node
+    in_degree = np.bincount(indices, minlength=len(equivalence_classes))
+    # mask of nodes utilized in paths, only reset on the nodes of each
+    # subgraph since paths never leave their subgraph
+    visited = np.zeros(len(equivalence_classes), dtype=bool)
     # split cell-wide graph into subgraphs of connected nodes
-    subgraphs = [graph.subgraph(x) for x in
-                 nx.connected_components(graph.to_undirected())]
-    # put aside networks that will be solved with EM
-    em_array = []
-    # solve UMI deduplication for each subgraph of connected nodes
-    for subg in subgraphs:
+    for subg in connected_components(indptr, indices):
+        subg = subg.tolist()
+        if len(subg) == 1:
+            # isolated node: a single path made by the node itself
+            yield [subg], [list(node_features[subg[0]])]
+            continue
         # find all parent nodes in graph
-        parents = [x for x in subg if not list(subg.predecessors(x))]
+        parents = [x for x in subg if not in_degree[x]]
         if not parents:
             # if no parents are found due to bidirected edges, take all nodes
             # and the union of all features (i.e. all nodes are parents).
-            parents = list(subg.nodes)
-            features = [list(set.union(*[subg.nodes[x]['ft'] for x in subg]))]
+            parents = list(subg)
+            features = [list(set.union(*[node_features[x] for x in subg]))]
         else:
             # if parents node are found, features will be determined below.
             features = None
@@ -147,53 +193,88 @@ def compute_cell_counts(equivalence_classes, features_index, max_iters,
         paths = {x: [] for x in parents}
         # find paths starting from each parent node
         for parent in parents:
-            # populate this list with nodes utilized in paths
-            blacklist = []
+            visited[subg] = False
             # find paths in list of nodes starting from parent
             path = []
-            subg_copy = subg.copy()
-            nodes = [parent] + [x for x in subg_copy if x != parent]
+            nodes = [parent] + [x for x in subg if x != parent]
             for node in nodes:
-                # make a copy of subgraph and remove nodes already used
-                # in a path
-                if node not in blacklist:
-                    path = pathfinder(subg_copy, node, path=[], features=None)
-                    for x in path:
-                        blacklist.append(x)
-                        subg_copy.remove_node(x)
+                # skip nodes already used in a path
+                if not visited[node]:
+                    path = pathfinder(
+                        indptr, indices, node_features, node, visited
+                    )
                     paths[parent].append(path)
         # find the path configuration leading to the minimum number of
         # deduplicated UMIs -> list of lists of nodes
-        path_config = [
-            paths[k] for k, v in paths.items()
-            if len(v) == min([len(x) for x in paths.values()])
-        ][0]
+        # (the first one in case of ties)
+        path_config = min(paths.values(), key=len)
         if not features:
             # take features from parent node of selected path configuration
-            features = [list(subg.nodes[x[0]]['ft']) for x in path_config]
+            features = [list(node_features[x[0]]) for x in path_config]
         else:
             # if features was already determined (i.e. no parent nodes),
             # multiplicate the feature's list by the number of paths
             # in path_config to avoid going out of list range
             features *= len(path_config)
+        if not all(features):
+            writerr(str({x: indices[indptr[x]:indptr[x+1]].tolist()
+                         for x in subg}))
+            writerr(str([node_features[x] for x in subg]))
+            writerr(str([equivalence_classes[x].count for x in subg]))
+            writerr(str(path_config))
+            writerr(str(path))
+            writerr(str(features))
+            writerr("Error: no common features detected in subgraph's"
+                    " path.", error=True)
+        yield path_config, features
+
+def compute_cell_counts(equivalence_classes, max_iters, tolerance, dumpEC):
+    """
+    Calculate TE counts of a single cell, given a list of equivalence classes.
+
+    Parameters
+    ----------
+    equivalence_classes : list
+        EquivalenceClass objects of a single cell, sorted by index.
+    max_iters : int
+        Maximum number of EM cycles.
+    tolerance : float
+        Log-likelihood change below which the EM is considered converged.
+    dumpEC : bool
+        Whether to collect the deduplication log of equivalence classes.
+
+    Returns
+    -------
+    out : dict
+        feature <int>: count <float> dictionary.
+    dump : dict
+        Equivalence class index <int>: deduplication log <tuple>
+        dictionary, or None if dumpEC is False.
+    em_stats : tuple
+        EM cycles and convergence, as returned by run_em(), or
+        (None, None) if no UMI needed the EM.
+    """
+    # initialize dedup log
+    dump = None
+    if dumpEC:
+        # collect graph metadata in a dictionary
+        dump = {x.index: x.to_tuple() for x in equivalence_classes}
+    # put aside networks that will be solved with EM, as the list of
+    # compatible features of each row of the reads-features matrix
+    em_feats = []
+    # features having at least one row in em_feats
+    used_feats = set()
+    # features of UMIs assigned to a single feature, one item per UMI
+    singletons = []
+    # solve UMI deduplication for each subgraph of connected nodes
+    for path_config, features in deduplicate(equivalence_classes):
         # assign UMI count to features
         for feats in features:
             if len(feats) == 1:
-                counts[feats[0]] += 1.0
-            elif len(feats) > 1:
-                row = [1 if x in feats else 0
-                       for x in range(1, number_of_features+1)]
-                em_array.append(row)
+                singletons.append(feats[0])
             else:
-                writerr(nx.to_dict_of_lists(subg))
-                writerr([subg.nodes[x]['ft'] for x in subg.nodes])
-                writerr([subg.nodes[x]['count'] for x in subg.nodes])
-                writerr(path_config)
-                writerr(path)
-                writerr(features)
-                writerr(feats)
-                writerr("Error: no common features detected in subgraph's"
-                        " path.", error=True)
+                em_feats.append(feats)
+                used_feats.update(feats)
         # add EC log to dump
         if dumpEC:
             for i, path_ in enumerate(path_config):
@@ -205,119 +286,210 @@ def compute_cell_counts(equivalence_classes, features_index, max_iters,
                 for x in path_:
                     # add parent's UMI sequence and dedup features
                     dump[x] += (dump[parent_][0], features[i])
+    # initialize TE counts with the UMIs of single features
+    counts = Counter()
+    if singletons:
+        singletons = np.bincount(singletons)
+        nonzero = np.flatnonzero(singletons)
+        counts.update(dict(zip(
+            nonzero.tolist(), singletons[nonzero].astype(float).tolist()
+        )))
     # EM stats placeholder in case of no multimapped UMIs
     em_stats = (None, None)
-    if em_array:
+    if em_feats:
         # optimize the assignment of UMI from multimapping reads
-        em_array = np.array(em_array)
-        # save an array with features > 0, as in em_array order
-        tokeep = np.argwhere(np.any(em_array[..., :] > 0, axis=0))[:,0] + 1
-        # remove unmapped features from em_array
-        todel = np.argwhere(np.all(em_array[..., :] == 0, axis=0))
-        em_array = np.delete(em_array, todel, axis=1)
+        # (row, feature) coordinates of compatible pairs
+        sizes = np.fromiter(map(len, em_feats), dtype=np.int64,
+                            count=len(em_feats))
+        em_rows = np.repeat(np.arange(len(em_feats)), sizes)
+        # save a list of features with at least one read, in ascending
+        # order, as columns of em_array
+        tokeep = sorted(used_feats)
+        columns = {ft: i for i, ft in enumerate(tokeep)}
+        em_cols = np.fromiter(
+            (columns[ft] for ft in chain.from_iterable(em_feats)),
+            dtype=np.int64, count=sizes.sum()
+        )
+        em_array = np.zeros((len(em_feats), len(tokeep)), dtype=np.float32)
+        em_array[em_rows, em_cols] = 1
         # run EM
         em_counts, em_stats = run_em(
             em_array,
             cycles=max_iters,
             tolerance=tolerance
         )
-        em_counts = [x*em_array.shape[0] for x in em_counts]
+        em_counts = [x*em_array.shape[0] for x in em_counts.tolist()]
         for i, c in zip(tokeep, em_counts):
             if c > 0:
                 counts[i] += c
     return dict(counts), dump, em_stats
 
-def split_barcodes(barcodes_file, n):
+def index_barcodes(barcodes_file):
     """
-    barcode_file : iterable
-    n : int
+    barcode_file : str
     ----------
-    out : int, dict
+    out : dict
+        barcode <bytes>: index <int> dictionary.
     """
-    nBarcodes = getlen(barcodes_file)
-    with gzip.open(barcodes_file, 'rb') as f:
-        for i, chunk in enumerate(get_ranges(nBarcodes, n)):
-            yield i, {next(f).strip(): x+1 for x in chunk}
+    with igzip.open(barcodes_file, 'rb') as f:
+        return {line.strip(): i for i, line in enumerate(f, start=1)}
 
-def run_count(maps_file, features_index, tmpdir, dumpEC, max_iters, tolerance,
-              verbose, barcodes_set):
-    # NB: keep args order consistent with main.countFun
-    taskn, barcodes = barcodes_set
-    matrix_file = os.path.join(tmpdir, f'{taskn}_matrix.mtx.gz')
-    dump_file = os.path.join(tmpdir, f'{taskn}_EqCdump.tsv.gz')
-    with gzip.open(matrix_file, 'wb') as f, \
-            gzip.open(dump_file, 'wb') if dumpEC \
-            else gzip.open(os.devnull) as df:
-        for cellbarcode, cellmaps in parse_maps(maps_file, features_index):
-            if cellbarcode not in barcodes:
-                continue
-            cellidx = barcodes[cellbarcode]
-            writerr(
-                f'[{taskn}] Run count for cell '
-                f'{cellidx} ({cellbarcode.decode()})',
-                level=2, send=verbose
-            )
-            cellcounts, dump, em_stats = compute_cell_counts(
-                equivalence_classes=cellmaps,
-                features_index=features_index,
-                max_iters=max_iters,
-                tolerance=tolerance,
-                dumpEC=dumpEC
-            )
-            writerr(
-                f'[{taskn}] Write cell {cellidx} ({cellbarcode.decode()}). '
-                f'EM cycles: {em_stats[0]}. Coverged: {em_stats[1]}.',
-                level=1, send=verbose
-            )
-            # round counts to 3rd decimal point and write to matrix file
-            # only if count is at least 0.001
-            lines = [f'{feature} {cellidx} {round(count, 3)}\n'.encode()
-                     for feature, count in cellcounts.items()
-                     if count >= 0.001]
+# arguments shared by all cells, set once per worker by init_count_worker()
+count_args = {}
+
+def init_count_worker(features_index, barcodes, dumpEC, max_iters, tolerance,
+                      verbose):
+    count_args.update(
+        features_index=features_index,
+        # reverse features index to get names back
+        features_names={v: k for k, v in features_index.items()},
+        barcodes=barcodes,
+        dumpEC=dumpEC,
+        max_iters=max_iters,
+        tolerance=tolerance,
+        verbose=verbose
+    )
+
+def process_cell(cellbarcode, cellidx, cellmaps):
+    """
+    Calculate TE counts of a single cell and format them as matrix lines
+    (and EC dump lines, if required).
+
+    Parameters
+    ----------
+    cellbarcode : bytes
+    cellidx : int
+    cellmaps : list
+        Mappings lines of the cell.
+
+    Returns
+    -------
+    out : list, list
+        Matrix lines, EC dump lines.
+    """
+    features_index = count_args['features_index']
+    cellmaps = get_equivalence_classes(cellmaps, features_index)
+    dumpEC = count_args['dumpEC']
+    verbose = count_args['verbose']
+    writerr(
+        f'Run count for cell {cellidx} ({cellbarcode.decode()})',
+        level=2, send=verbose
+    )
+    cellcounts, dump, em_stats = compute_cell_counts(
+        equivalence_classes=cellmaps,
+        max_iters=count_args['max_iters'],
+        tolerance=count_args['tolerance'],
+        dumpEC=dumpEC
+    )
+    writerr(
+        f'Write cell {cellidx} ({cellbarcode.decode()}). '
+        f'EM cycles: {em_stats[0]}. Coverged: {em_stats[1]}.',
+        level=1, send=verbose
+    )
+    # round counts to 3rd decimal point and write to matrix file
+    # only if count is at least 0.001
+    lines = [f'{feature} {cellidx} {round(count, 3)}\n'.encode()
+             for feature, count in cellcounts.items()
+             if count >= 0.001]
+    dumplines = []
+    if dumpEC:
+        writerr(
+            f'Write ECdump for cell {cellidx} ({cellbarcode.decode()})',
+            level=1, send=verbose
+        )
+        findex = count_args['features_names']
+        dumplines = [
+            b'\t'.join(
+                [str(cellidx).encode(),
+                 cellbarcode,
+                 str(i).encode(),
+                 umi,
+                 b','.join([findex[f] for f in feats]),
+                 str(count).encode(),
+                 pumi,
+                 b','.join([findex[f] for f in pfeats])]
+            ) + b'\n'
+            for i, (umi, feats, count, pumi, pfeats) in dump.items()
+        ]
+    return lines, dumplines
+
+def process_maps(block):
+    """
+    Calculate TE counts of the barcodes' cells found in a block of mappings.
+
+    Parameters
+    ----------
+    block : bytes
+        Mappings lines, as returned by read_maps().
+
+    Returns
+    -------
+    out : list, list
+        Matrix lines, EC dump lines.
+    """
+    barcodes = count_args['barcodes']
+    lines = []
+    dumplines = []
+    for cellbarcode, cellmaps in parse_maps(block):
+        if cellbarcode not in barcodes:
+            continue
+        cell_lines, cell_dumplines = process_cell(
+            cellbarcode, barcodes[cellbarcode], cellmaps
+        )
+        lines += cell_lines
+        dumplines += cell_dumplines
+    return lines, dumplines
+
+def run_count(maps_file, features_index, barcodes, tmpdir, dumpEC, max_iters,
+              tolerance, verbose, threads):
+    """
+    Calculate TE counts of all cells in barcodes, distributing blocks of
+    cells across a pool of processes. The mappings file is read once, and
+    results are written by the main process.
+    """
+    matrix_file = os.path.join(tmpdir, 'matrix.mtx.gz')
+    dump_file = os.path.join(tmpdir, 'EqCdump.tsv.gz')
+    initargs = (features_index, barcodes, dumpEC, max_iters, tolerance,
+                verbose)
+    blocks = read_maps(maps_file)
+    # the pool is terminated on exit, also if an error occurs while
+    # processing or writing the results
+    with Pool(threads, initializer=init_count_worker, initargs=initargs) \
+            if threads > 1 else nullcontext() as pool, \
+            igzip.open(matrix_file, 'wb') as f, \
+            igzip.open(dump_file, 'wb') if dumpEC else nullcontext() as df:
+        if pool:
+            results = pool.imap_unordered(process_maps, blocks)
+        else:
+            init_count_worker(*initargs)
+            results = map(process_maps, blocks)
+        for lines, dumplines in results:
             f.writelines(lines)
             if dumpEC:
-                writerr(
-                    f'[{taskn}] Write ECdump for cell '
-                    f'{cellidx} ({cellbarcode.decode()})',
-                    level=1, send=verbose
-                )
-                # reverse features index to get names back
-                findex = dict(zip(features_index.values(),
-                                  features_index.keys()))
-                dumplines = [
-                    b'\t'.join(
-                        [str(cellidx).encode(),
-                         cellbarcode,
-                         str(i).encode(),
-                         umi,
-                         b','.join([findex[f] for f in feats]),
-                         str(count).encode(),
-                         pumi,
-                         b','.join([findex[f] for f in pfeats])]
-                    ) + b'\n'
-                    for i, (umi, feats, count, pumi, pfeats) in dump.items()
-                ]
                 df.writelines(dumplines)
     return matrix_file, dump_file
 
-def formatMM(matrix_files, feature_index, barcodes_chunks, outdir):
+def formatMM(matrix_files, feature_index, barcodes, outdir, threads=1):
     if type(matrix_files) is str:
         matrix_files = [matrix_files]
     matrix_out = os.path.join(outdir, 'matrix.mtx.gz')
     features_count = len(feature_index)
-    barcodes_count = sum(len(x) for _, x in barcodes_chunks)
+    barcodes_count = len(barcodes)
     mmsize = sum(getlen(f) for f in matrix_files)
     mmheader = b'%%MatrixMarket matrix coordinate real general\n'
     mmtotal = f'{features_count} {barcodes_count} {mmsize}\n'.encode()
+    # NB: final outputs are written with zlib for reproducibility
     with gzip.GzipFile(matrix_out, 'wb', mtime=0) as mmout:
         mmout.write(mmheader)
         mmout.write(mmtotal)
     mtxstr = ' '.join(matrix_files)
-    cmd = f'zcat {mtxstr} | LC_ALL=C sort -k2,2n -k1,1n | gzip >> {matrix_out}'
+    unzip, _ = gzip_cmds(threads)
+    cmd = f'{unzip} {mtxstr} | LC_ALL=C sort --parallel {threads} -k2,2n -k1,1n'
+    cmd += f' | gzip >> {matrix_out}'
     run_shell_cmd(cmd)
     return(matrix_out)
 
-def writeEC(ecdump_files, outdir):
+def writeEC(ecdump_files, outdir, threads=1):
     if type(ecdump_files) is str:
         ecdump_files = [ecdump_files]
     ecdump_out = os.path.join(outdir, 'ec_dump.tsv.gz')
@@ -334,6 +506,8 @@ def writeEC(ecdump_files, outdir):
     ]) + '\n'
     with gzip.GzipFile(ecdump_out, 'wb', mtime=0) as f:
         f.write(header.encode())
-    cmd = f'zcat {ecdumpstr} | LC_ALL=C sort -k1,1n -k3,3n | gzip >> {ecdump_out}'
+    unzip, _ = gzip_cmds(threads)
+    cmd = f'{unzip} {ecdumpstr} | LC_ALL=C sort --parallel {threads} -k1,1n -k3,3n'
+    cmd += f' | gzip >> {ecdump_out}'
     run_shell_cmd(cmd)
     return ecdump_out
\ No newline at end of file
@@ -5,6 +5,8 @@ def e_step(matrix, counts):
     Performs E-step of EM algorithm: proportionally assigns reads to features
     based on relative feature abundances.
     """
+    # double precision abundances are rounded to the matrix dtype
+    counts = counts.astype(matrix.dtype)
     colsums = (matrix * counts).sum(axis=1)[:, np.newaxis]
     out = matrix / colsums * counts
     return(out)
@@ -14,28 +16,49 @@ def m_step(matrix):
     Performs M-step of EM algorithm: calculates feature abundances from read
     counts proportionally distributed to features.
     """
-    counts = matrix.sum(axis=0) / matrix.sum()
+    # accumulate in double precision: column sums of a float32 matrix are
+    # not summed pairwise and their rounding grows with the number of rows.
+    colsums = matrix.sum(axis=0, dtype=np.float64)
+    counts = colsums / colsums.sum()
     return(counts)
 
 def log_likelihood(matrix, counts):
     """
     Compute log-likelihood of data.
     """
-    likelihoods = (matrix * counts).sum(axis=1)
-    log_likelihood = np.sum(np.log(likelihoods + np.finfo(float).eps))
+    # compute in double precision even for a float32 matrix: single
+    # precision rounding of the row likelihoods would be larger than the
+    # convergence tolerance on large cells.
+    likelihoods = (matrix * counts).sum(axis=1, dtype=np.float64)
+    log_likelihood = np.sum(np.log(likelihoods + np.finfo(np.float64).eps))
     return log_likelihood
 
+def em_update(matrix, counts):
+    """
+    Performs a full EM cycle: E-step followed by M-step.
+    """
+    return m_step(matrix=e_step(matrix=matrix, counts=counts))
+
 def run_em(matrix, cycles=100, tolerance=1e-5):
     """
     Run Expectation-Maximization (EM) algorithm to redistribute read counts
     across a set of features.
 
+    The EM is accelerated with SQUAREM (Varadhan & Roland, 2008): every
+    iteration extrapolates the abundances from two EM cycles, then stabilizes
+    the extrapolated point with one more EM cycle. The plain EM cycles are
+    used instead whenever the extrapolation leaves the parameter space or
+    decreases the log-likelihood.
+
     Parameters
     ----------
     matrix : array
-        Reads-features compatibility matrix.
+        Reads-features compatibility matrix. The E-step is computed in its
+        dtype promoted to floating point, i.e. np.result_type(dtype, float32)
+        (float32 stays float32, int64 becomes float64), while feature
+        abundances and log-likelihoods are kept in double precision.
     cycles : int, optional
-        Number of EM cycles.
+        Maximum number of EM cycles.
     tolerance : float
         Tolerance threshold of log-likelihood difference to infer convergence.
 
@@ -49,11 +72,16 @@ def run_em(matrix, cycles=100, tolerance=1e-5):
         Indicates if convergence has been reached before cycles theshold.
     """
 
+    # compute in floating point: float32 is kept, other dtypes (e.g. an
+    # integer matrix) are promoted as needed
+    matrix = matrix.astype(np.result_type(matrix.dtype, np.float32),
+                           copy=False)
+
     # calculate initial estimation of relative abundance.
     # (let the sum of counts of features be 1,
     # will be multiplied by the real UMI count later)
     nFeatures = matrix.shape[1]
-    counts = np.array([1 / nFeatures] * nFeatures)
+    counts = np.full(nFeatures, 1 / nFeatures, dtype=np.float64)
 
     # Initial log-likelihood
     prev_loglik = log_likelihood(matrix, counts)
@@ -63,12 +91,34 @@ def run_em(matrix, cycles=100, tolerance=1e-5):
 
     # Run EM iterations
     while curr_cycle < cycles:
+        counts1 = em_update(matrix, counts)
         curr_cycle += 1
-        e_matrix = e_step(matrix=matrix, counts=counts)
-        counts = m_step(matrix=e_matrix)
-
-        # Compute the new log-likelihood
-        loglik = log_likelihood(matrix, counts)
+        if curr_cycle < cycles:
+            counts2 = em_update(matrix, counts1)
+            curr_cycle += 1
+        else:
+            counts2 = counts1
+        # SQUAREM step length, with alpha=-1 falling back to counts2
+        r = counts1 - counts
+        v = counts2 - counts1 - r
+        v_norm = np.linalg.norm(v)
+        if v_norm > 0 and curr_cycle < cycles:
+            alpha = min(-1, -np.linalg.norm(r) / v_norm)
+            extrapolated = counts - 2 * alpha * r + alpha ** 2 * v
+        else:
+            extrapolated = None
+        if extrapolated is not None and (extrapolated > 0).all():
+            counts = em_update(matrix, extrapolated / extrapolated.sum())
+            curr_cycle += 1
+            loglik = log_likelihood(matrix, counts)
+            # EM cycles never decrease the log-likelihood, unlike
+            # extrapolation
+            if loglik < prev_loglik:
+                counts = counts2
+                loglik = log_likelihood(matrix, counts)
+        else:
+            counts = counts2
+            loglik = log_likelihood(matrix, counts)
 
         # Check for convergence
         if np.abs(loglik - prev_loglik) < tolerance:
@@ -5,8 +5,8 @@ from irescue._genomes import __genomes__
 from irescue.misc import writerr, versiontuple, run_shell_cmd
 from irescue.misc import check_requirement, check_tags
 from irescue.map import makeRmsk, getRefs, prepare_whitelist, isec, chrcat
-from irescue.map import checkIndex
-from irescue.count import split_barcodes, index_features, run_count, formatMM, writeEC
+from irescue.map import checkIndex, IsecError
+from irescue.count import index_barcodes, index_features, run_count, formatMM, writeEC
 import argparse, os, sys
 from multiprocessing import Pool
 from functools import partial
@@ -67,9 +67,8 @@ def parseArguments():
     parser.add_argument('--integers', action='store_true',
                         help="Use if integers count are needed for "
                         "downstream analysis.")
-    parser.add_argument('--samtools', default='samtools', metavar='PATH',
-                        help="Path to samtools binary, in case it's not in "
-                        "PATH (Default: %(default)s).")
+    # deprecated: samtools is no longer used, kept for compatibility
+    parser.add_argument('--samtools', metavar='PATH', help=argparse.SUPPRESS)
     parser.add_argument('--bedtools', default='bedtools', metavar='PATH',
                         help="Path to bedtools binary, in case it's not in "
                         "PATH (Default: %(default)s).")
@@ -118,11 +117,9 @@ def main():
         ),
         args.verbose
     )
-    check_requirement(
-        args.samtools, '1.11',
-        lambda: versiontuple(run_shell_cmd('samtools --version').split()[1]),
-        args.verbose
-    )
+    if args.samtools:
+        writerr("WARNING: --samtools is deprecated and will be removed in a "
+                "future version: samtools is no longer required.")
 
     # Check if the selected cell barcode and UMI tags are present in bam file.
     if not args.no_tags_check:
@@ -154,9 +151,11 @@ def main():
     # decompress whitelist if compressed
     whitelist = prepare_whitelist(args.whitelist, dirs['tmp'])
 
-    # Allocate threads
-    if args.threads > 1:
-        pool = Pool(args.threads)
+    # Allocate threads: one worker per reference, up to the number of
+    # threads, and the remaining threads split among the workers to
+    # (de)compress the temporary files.
+    workers = min(args.threads, len(chrNames))
+    isec_threads = max(1, args.threads // workers)
 
     # Execute intersection between reads and TE coordinates
     writerr(
@@ -167,12 +166,18 @@ def main():
     isecFun = partial(
         isec, args.bam, regions, whitelist, args.cb_tag, args.umi_tag,
         args.min_bp_overlap, args.min_fraction_overlap, dirs['tmp'],
-        args.samtools, args.bedtools, args.verbose
+        args.bedtools, args.verbose, isec_threads
     )
-    if args.threads > 1:
-        isecFiles = pool.map(isecFun, chrNames)
-    else:
-        isecFiles = list(map(isecFun, chrNames))
+    try:
+        if workers > 1:
+            # references are sorted by size: dispatch them one at a time to
+            # balance the load between workers
+            with Pool(workers) as pool:
+                isecFiles = pool.map(isecFun, chrNames, chunksize=1)
+        else:
+            isecFiles = list(map(isecFun, chrNames))
+    except IsecError as e:
+        writerr(f'Error: {e}', error=True)
 
     # concatenate intersection results
     mappings_file, barcodes_file, features_file = chrcat(
@@ -187,36 +192,26 @@ def main():
 
     writerr("Running count step.")
 
-    # calculate number of mappings per process
-    bc_per_thread = list(split_barcodes(barcodes_file, args.threads))
+    # parse barcodes
+    barcodes = index_barcodes(barcodes_file)
 
     # parse features
     feature_index = index_features(features_file)
 
     # calculate TE counts
-    countFun = partial(
-        run_count, mappings_file, feature_index, dirs['tmp'],
-        args.dump_ec, args.max_iters, args.tolerance, args.verbose
+    matrix_file, ecdump_file = run_count(
+        mappings_file, feature_index, barcodes, dirs['tmp'], args.dump_ec,
+        args.max_iters, args.tolerance, args.verbose, args.threads
     )
-    if args.threads > 1:
-        mtxFiles = pool.map(countFun, bc_per_thread)
-    else:
-        mtxFiles = list(map(countFun, bc_per_thread))
-
-    # close processes pool
-    if args.threads > 1:
-        pool.close()
-        pool.join()
-
-    # concatenate matrix files chunks
-    matrix_files = [ i for i, j in mtxFiles]
-    ecdump_files = [ j for i, j in mtxFiles]
+
+    # sort matrix file
     matrix_file = formatMM(
-        matrix_files, feature_index, bc_per_thread, dirs['mex']
+        matrix_file, feature_index, barcodes, dirs['mex'], args.threads
     )
     writerr(f'Writing sparse matrix to {matrix_file}')
     if args.dump_ec:
-        ecdump_file = writeEC(ecdump_files, outdir=dirs['out'])
+        ecdump_file = writeEC(ecdump_file, outdir=dirs['out'],
+                              threads=args.threads)
         writerr(f'Writing Equivalence Classes to {ecdump_file}')
 
     if not args.keeptmp:
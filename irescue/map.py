@@ -5,9 +5,14 @@ from irescue.misc import writerr
 from irescue.misc import unGzip
 from irescue.misc import run_shell_cmd
 from irescue.misc import getlen
+from irescue.misc import igzip
+from irescue.misc import gzip_cmds
 from pysam import idxstats, AlignmentFile, index
 from gzip import open as gzopen
-import requests, io, os
+import requests, io, os, re, subprocess, tempfile
+
+# Homopolymer UMIs, discarded during mapping
+HOMOPOLYMER = re.compile(r'A+|C+|G+|T+')
 
 # Check if bam file is indexed
 def checkIndex(bamFile, verbose):
@@ -70,7 +75,7 @@ def makeRmsk(regions, genome, genomes, tmpdir, outname):
                 "Couldn't connect to host.",
                 error=True
             )
-        rmsk = gzopen(io.BytesIO(response.content), 'rb')
+        rmsk = igzip.open(io.BytesIO(response.content), 'rb')
         out = os.path.join(tmpdir, outname)
         with open(out, 'w') as f:
             # print header
@@ -123,15 +128,19 @@ def prepare_whitelist(whitelist, tmpdir):
     return whitelist
 
 # Get list of reference names from BAM file, skipping those without reads.
+# References are sorted by decreasing number of reads, so that the largest
+# ones are processed first when running in parallel.
 def getRefs(bamFile, bedFile):
-    chrNames = list()
+    chrReads = list()
     for line in idxstats(bamFile).strip().split('\n'):
         l = line.strip().split('\t')
         if int(l[2])>0:
-            chrNames.append(l[0])
+            chrReads.append((l[0], int(l[2])))
+    chrReads.sort(key=lambda x: x[1], reverse=True)
+    chrNames = [x[0] for x in chrReads]
     bedChrNames = set()
     if testGz(bedFile):
-        with gzopen(bedFile, 'rb') as f:
+        with igzip.open(bedFile, 'rb') as f:
             for line in f:
                 bedChrNames.add(line.decode().split('\t')[0])
     else:
@@ -158,9 +167,39 @@ def getRefs(bamFile, bedFile):
             error=True
         )
 
+# Raised by isec() when the intersection of a chromosome fails. Unlike
+# writerr(..., error=True), it reaches the main process from the pool workers.
+class IsecError(Exception):
+    pass
+
+# Write the alignments of a chromosome as uncompressed BAM to a file object,
+# appending CB and UMI to the read names.
+def filterAlignments(bamFile, whitelist, CBtag, UMItag, chrom, out):
+    if whitelist:
+        with open(whitelist, 'r') as f:
+            whitelist = set(line.strip() for line in f)
+    with AlignmentFile(bamFile) as bam, \
+            AlignmentFile(out, 'wbu', template=bam) as outbam:
+        for read in bam.fetch(chrom):
+            try:
+                cb = str(read.get_tag(CBtag))
+                umi = str(read.get_tag(UMItag))
+            except KeyError:
+                # Discard records without CB or UMI tag
+                continue
+            # Discard unvalid STARSolo CBs, CBs not in whitelist, UMIs with
+            # Ns and homopolymer UMIs
+            if (cb in ('', '-') or (whitelist and cb not in whitelist)
+                    or not umi or 'N' in umi or HOMOPOLYMER.fullmatch(umi)):
+                continue
+            read.query_name = f'{read.query_name}/{cb}/{umi}'
+            outbam.write(read)
+
 # Intersect reads with repeatmasker regions. Return the intersection file path.
+# threads is the number of threads used to (de)compress the temporary files
+# of a single chromosome, i.e. the share of one of the parallel workers.
 def isec(bamFile, bedFile, whitelist, CBtag, UMItag, bpOverlap, fracOverlap,
-         tmpdir, samtools, bedtools, verbose, chrom):
+         tmpdir, bedtools, verbose, threads, chrom):
     refdir = os.path.join(tmpdir, 'refs')
     isecdir = os.path.join(tmpdir, 'isec')
     os.makedirs(refdir, exist_ok=True)
@@ -169,50 +208,62 @@ def isec(bamFile, bedFile, whitelist, CBtag, UMItag, bpOverlap, fracOverlap,
     refFile = os.path.join(refdir, chrom + '.bed.gz')
     isecFile = os.path.join(isecdir, chrom + '.isec.txt.gz')
 
+    unzip, gz = gzip_cmds(threads)
+
     # split bed file by chromosome
     sort = 'LC_ALL=C sort -k1,1 -k2,2n --buffer-size=1G'
     if bedFile[-3:] == '.gz':
-        cmd0 = f'zcat {bedFile} | gawk \'$1=="{chrom}"\' '
-        cmd0 += f' | {sort} | gzip > {refFile}'
+        cmd0 = f'{unzip} {bedFile} | gawk \'$1=="{chrom}"\' '
+        cmd0 += f' | {sort} | {gz} > {refFile}'
     else:
-        cmd0 = f'gawk \'$1=="{chrom}"\' {bedFile} | {sort} | gzip > {refFile}'
-
-    # command streaming alignments for intersection
-    if whitelist:
-        stream = f' <({samtools} view -h {bamFile} -D {CBtag}:{whitelist} {chrom} | '
-    else:
-        stream = f' <({samtools} view -h {bamFile} {chrom} | '
-    stream += ' gawk \'!($1~/^@/) { split("", tags); '
-    stream += ' for (i=12;i<=NF;i++) {split($i,tag,":"); tags[tag[1]]=tag[3]}; '
-    # Discard records without CB tag, unvalid STARSolo CBs, missing UMI tag,
-    # UMIs with Ns and homopolymer UMIs
-    stream += f' if(tags["{CBtag}"]~/^(|-)$/ || tags["{UMItag}"]~/.*N.*/ || '
-    stream += f' tags["{UMItag}"]~/^$|^(A+|G+|T+|C+)$/) {{next}}; '
-    # Append CB and UMI to read name
-    stream += f' $1=$1"/"tags["{CBtag}"]"/"tags["{UMItag}"]; '
-    stream += ' } '
-    stream += ' { OFS="\\t"; print }\' | '
-    stream += f' {samtools} view -u - | '
-    stream += f' {bedtools} bamtobed -i stdin -bed12 -split -splitD) '
+        cmd0 = f'gawk \'$1=="{chrom}"\' {bedFile} | {sort} | {gz} > {refFile}'
 
     # filter by minimum overlap between read and feature, if set
     ovfrac = f' -f {fracOverlap} ' if fracOverlap else ''
     ovbp = f' $NF>={bpOverlap} ' if bpOverlap else ''
 
-    # intersection command
-    cmd = f'{bedtools} intersect -a {stream} -b {refFile} '
+    # intersection command, reading the alignments streamed to stdin by
+    # filterAlignments()
+    cmd = f'{bedtools} bamtobed -i stdin -bed12 -split -splitD '
+    cmd += f' | {bedtools} intersect -a stdin -b {refFile} '
     cmd += f' -split -bed -wo -sorted {ovfrac} | gawk -vOFS="\\t" \'{ovbp} '
     # remove mate information from read name
     cmd += ' { sub(/\\/[12]$/,"",$4); '
     # concatenate CB and UMI with feature name
     cmd += ' n=split($4,qname,/\\//); '
     cmd += ' print qname[n-1]"\\t"qname[n]"\\t"qname[1]"\\t"$16 }\' '
-    cmd += f' | gzip > {isecFile}'
+    cmd += f' | {gz} > {isecFile}'
 
     writerr(f'Extracting {chrom} reference', level=2, send=verbose)
     run_shell_cmd(cmd0)
     writerr(f'Mapping alignments to {chrom}', level=1, send=verbose)
-    run_shell_cmd(cmd)
+    with tempfile.TemporaryFile(dir=isecdir) as stderr:
+        p = subprocess.Popen(
+            ['/bin/bash', '-o', 'pipefail', '-c', cmd],
+            stdin=subprocess.PIPE,
+            stderr=stderr
+        )
+        try:
+            with p.stdin:
+                filterAlignments(bamFile, whitelist, CBtag, UMItag, chrom,
+                                 p.stdin)
+        except OSError as e:
+            # the pipeline exited before reading all the alignments
+            # (BrokenPipeError is a subclass of OSError)
+            write_error = e
+        else:
+            write_error = None
+        p.wait()
+        if p.returncode or write_error:
+            msg = (f'Mapping alignments to {chrom} failed '
+                   f'(exit status {p.returncode}).')
+            if write_error:
+                msg += f' Could not stream alignments: {write_error}.'
+            stderr.seek(0)
+            log = stderr.read().decode(errors='replace').strip()
+            if log:
+                msg += '\n' + log
+            raise IsecError(msg)
     writerr(f'Mapped {chrom}', level=1, send=verbose)
 
     return isecFile
@@ -226,10 +277,12 @@ def chrcat(filesList, threads, outdir, tmpdir, bedtools, verbose):
     bedFiles = ' '.join(filesList)
     sort_threads = int(threads / 2 - 1)
     sort_threads = sort_threads if sort_threads>0 else 1
+    # NB: final outputs are compressed with gzip for reproducibility
+    unzip, gz = gzip_cmds(threads)
 
     # sort and summarize UMI-READ-TE mappings
     sort_res = f'--parallel {sort_threads} --buffer-size 2G'
-    cmd0 = f'zcat {bedFiles}'
+    cmd0 = f'{unzip} {bedFiles}'
         # input: "CB UMI READ FEAT"
     cmd0 += f' | LC_ALL=C sort -u {sort_res}'
     cmd0 += f' | {bedtools} groupby -g 1,2,3 -c 4 -o distinct'
@@ -237,13 +290,13 @@ def chrcat(filesList, threads, outdir, tmpdir, bedtools, verbose):
     cmd0 += f' | LC_ALL=C sort -k1,2 -k4,4 {sort_res}'
     cmd0 += f' | {bedtools} groupby -g 1,2,4 -c 3 -o count_distinct'
         # result: "CB UMI FEATs count"
-    cmd0 += f' | gzip > {mappings_file}'
+    cmd0 += f' | {gz} > {mappings_file}'
 
     # write barcodes.tsv.gz file
-    cmd1 = f'zcat {mappings_file} | cut -f1 | uniq | gzip > {barcodes_file} '
+    cmd1 = f'{unzip} {mappings_file} | cut -f1 | uniq | gzip > {barcodes_file} '
 
     # write features.tsv.gz file
-    cmd2 = f'zcat {mappings_file} '
+    cmd2 = f'{unzip} {mappings_file} '
     cmd2 += ' | cut -f3 | sed \'s/,/\\n/g\' | gawk \'!x[$1]++ { '
     cmd2 += ' print $1"\\t"gensub(/#.+/,"",1,$1)"\\tGene Expression" }\' '
     cmd2 += f' | LC_ALL=C sort -u | gzip > {features_file} '
@@ -8,6 +8,12 @@ from datetime import datetime
 from shutil import which
 import pysam
 
+# Intel ISA-L implementation of gzip, faster than zlib, if available.
+try:
+    from isal import igzip
+except ImportError:
+    igzip = gzip
+
 def run_shell_cmd(cmd):
     """
     Execute a command on bash shell with subprocess.
@@ -31,6 +37,20 @@ def check_path(cmdname):
     """
     return which(cmdname) is not None
 
+def gzip_cmds(threads=1):
+    """
+    Shell commands to decompress and compress a stream: multithreaded pigz
+    if available in PATH, otherwise zcat and gzip.
+
+    Returns
+    -------
+    out : str, str
+        Decompression command, compression command.
+    """
+    if check_path('pigz'):
+        return 'pigz -dc', f'pigz -p {threads}'
+    return 'zcat', 'gzip'
+
 def versiontuple(version):
     """
     Convert a semver string "X.Y.Z" to a tuple of integers (X, Y, Z).
@@ -115,7 +135,7 @@ def unGzip(input_file, output_file):
     input_file: gzip file to decompress.
     output_file: uncompressed file to write.
     """
-    with gzip.open(input_file, 'rb') as fin,\
+    with igzip.open(input_file, 'rb') as fin,\
     open(output_file, 'w') as fout:
         for line in fin:
             fout.write(line.decode('utf-8'))
@@ -126,7 +146,7 @@ def getlen(file):
     Count the number of lines in a file (plain or gzip-compressed).
     """
     if testGz(file):
-        f = gzip.open(file, 'rb')
+        f = igzip.open(file, 'rb')
     else:
         f = open(file, 'r')
     out = sum(1 for line in f)
@@ -199,16 +219,3 @@ def check_tags(
         )
     else:
         return(False)
-
-def get_ranges(num, div):
-    """
-    Splits an integer X into N integers whose sum is equal to X.
-    """
-    split = int(num/div)
-    for i in range(0, num, split):
-        j = i + split
-        if j > num-split:
-            j = num
-            yield range(i, j)
-            break
-        yield range(i, j)
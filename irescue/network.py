@@ -1,69 +1,324 @@
 #!/usr/bin/env python
 
-# NB: This module include partly modified third-party code distributed under the
-# license below.
-
-##############################################################################
-# The MIT License (MIT)
-
-# Copyright (c) 2015 CGAT
-
-# Permission is hereby granted, free of charge, to any person obtaining a copy
-# of this software and associated documentation files (the "Software"), to deal
-# in the Software without restriction, including without limitation the rights
-# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-# copies of the Software, and to permit persons to whom the Software is
-# furnished to do so, subject to the following conditions:
-
-# The above copyright notice and this permission notice shall be included in all
-# copies or substantial portions of the Software.
-
-# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-# SOFTWARE.
-##############################################################################
-
-from collections import defaultdict
-
-def get_substr_slices(umi_length, idx_size):
-    '''
-    Create slices to split a UMI into approximately equal size substrings
-    Returns a list of tuples that can be passed to slice function
-    '''
-    cs, r = divmod(umi_length, idx_size)
-    sub_sizes = [cs + 1] * r + [cs] * (idx_size - r)
-    offset = 0
-    slices = []
-    for s in sub_sizes:
-        slices.append((offset, offset + s))
-        offset += s
-    return slices
-
-def build_substr_idx(equivalence_classes, length, threshold):
-    '''
-    Group equivalence classes into subgroups having a common substring
-    '''
-    slices = get_substr_slices(length, threshold+1)
-    substr_idx = {k: defaultdict(set) for k in slices}
-    for idx in slices:
-        for ec in equivalence_classes:
-            sub = ec.umi[slice(*idx)]
-            substr_idx[idx][sub].add(ec)
-    return substr_idx
-
-def gen_ec_pairs(equivalence_classes, substr_idx):
-    '''
-    Yields equivalence classes pairs from build_substr_idx()
-    '''
-    for i, ec in enumerate(equivalence_classes, start=1):
-        neighbours = set()
-        for idx, substr_map in substr_idx.items():
-            sub = ec.umi[slice(*idx)]
-            neighbours = neighbours.union(substr_map[sub])
-        neighbours.difference_update(equivalence_classes[:i])
-        for nbr in neighbours:
-            yield ec, nbr
\ No newline at end of file
+import numpy as np
+
+# Upper bound to the number of elements of the temporary arrays allocated
+# when comparing UMIs pairwise, to keep memory usage bounded in large cells.
+BLOCK_ELEMENTS = 2 ** 24
+
+# 2-bit encoding of nucleotides (A=00, C=01, G=10, T=11, others=00)
+NT_CODES = np.zeros(256, dtype=np.uint64)
+for i, nt in enumerate(b'ACGT'):
+    NT_CODES[nt] = i
+    NT_CODES[nt + 32] = i
+# mask of the lower bit of each 2-bit slot in a 64-bit word
+LOW_BITS = np.uint64(0x5555555555555555)
+
+def pack_codes(codes):
+    """
+    Pack a (N, L) matrix of 2-bit codes into (N, ceil(L/32)) 64-bit words.
+    """
+    n, umi_length = codes.shape
+    packed = np.zeros((n, -(-umi_length // 32)), dtype=np.uint64)
+    for i in range(umi_length):
+        packed[:, i // 32] |= codes[:, i] << np.uint64(2 * (i % 32))
+    return packed
+
+def pack_umis(umis):
+    """
+    Pack UMI sequences into 64-bit words, 2 bits per nucleotide.
+
+    Parameters
+    ----------
+    umis : array
+        (N, L) matrix of UMI sequences bytes. UMIs are expected to be made of
+        A, C, G, T only (i.e. UMIs with Ns are filtered during mapping).
+
+    Returns
+    -------
+    out : array
+        (N, ceil(L/32)) matrix of packed UMIs.
+    """
+    return pack_codes(NT_CODES[umis])
+
+def pack_lengths(lengths, umi_length):
+    """
+    Mask of the 2-bit slots holding a nucleotide, for UMIs of different
+    lengths packed with pack_umis() after padding them to umi_length.
+
+    Returns
+    -------
+    out : array
+        (N, ceil(umi_length/32)) matrix with the lower bit of each slot set
+        if the slot is within the UMI length.
+    """
+    return pack_codes(
+        (np.arange(umi_length) < lengths[:, None]).astype(np.uint64)
+    )
+
+def popcount(x):
+    """
+    Count the bits set in each element of an array of 64-bit words.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    # SWAR fallback for numpy < 2.0
+    x = x - ((x >> np.uint64(1)) & LOW_BITS)
+    x = ((x & np.uint64(0x3333333333333333))
+         + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333)))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def hamming(a, b, slots_a=None, slots_b=None):
+    """
+    Hamming distance between packed UMIs, broadcasting a against b.
+
+    If UMIs have different lengths, slots_a and slots_b are their masks from
+    pack_lengths(): only the positions shared by both UMIs are compared, i.e.
+    positions beyond the shorter UMI are ignored.
+    """
+    out = 0
+    for i in range(a.shape[-1]):
+        x = a[..., i] ^ b[..., i]
+        # fold each 2-bit slot into its lower bit: one bit per mismatch
+        x = (x | (x >> np.uint64(1))) & LOW_BITS
+        if slots_a is not None:
+            x = x & slots_a[..., i] & slots_b[..., i]
+        out = out + popcount(x)
+    return out
+
+def block_hamming(umis, slots, rows, cols):
+    """
+    Hamming distance between the packed UMIs of a block of rows and a block
+    of columns, given as slices. slots is None if all UMIs have the same
+    length, otherwise their masks from pack_lengths().
+    """
+    if slots is None:
+        return hamming(umis[rows, None], umis[None, cols])
+    return hamming(umis[rows, None], umis[None, cols],
+                   slots[rows, None], slots[None, cols])
+
+def pack_features(features):
+    """
+    Pack sets of features into bitmaps of 64-bit words.
+
+    Parameters
+    ----------
+    features : list
+        Set of features of each node.
+
+    Returns
+    -------
+    out : array
+        (N, ceil(F/64)) matrix of bitmaps, with F the number of distinct
+        features in the list. Bit i is set if the node has the i-th feature
+        in ascending order.
+    """
+    allfeatures = sorted(set().union(*features))
+    index = {f: i for i, f in enumerate(allfeatures)}
+    sizes = [len(x) for x in features]
+    rows = np.repeat(np.arange(len(features)), sizes)
+    bits = np.fromiter(
+        (index[f] for x in features for f in x),
+        dtype=np.uint64, count=len(rows)
+    )
+    bitmaps = np.zeros((len(features), -(-len(allfeatures) // 64)),
+                       dtype=np.uint64)
+    np.bitwise_or.at(
+        bitmaps,
+        (rows, (bits >> np.uint64(6)).astype(np.intp)),
+        np.uint64(1) << (bits & np.uint64(63))
+    )
+    return bitmaps
+
+def overlap(a, b):
+    """
+    Test if feature bitmaps share at least one feature, broadcasting a
+    against b.
+    """
+    out = False
+    for i in range(a.shape[-1]):
+        out = out | ((a[..., i] & b[..., i]) != 0)
+    return out
+
+def build_graph(equivalence_classes, threshold):
+    """
+    Compute the directed edges of the UMI deduplication graph.
+
+    A node x is connected to a node y if x has at least 2*count(y)-1 reads,
+    the two nodes share at least one feature and the Hamming distance between
+    their UMI sequences is below or equal to threshold. UMIs of different
+    lengths are compared on the length of the shorter one only.
+
+    Parameters
+    ----------
+    equivalence_classes : list
+        EquivalenceClass objects of a single cell, sorted by index.
+    threshold : int
+        Maximum Hamming distance between connected UMIs.
+
+    Returns
+    -------
+    out : array, array
+        Graph adjacency in CSR format, as returned by to_csr().
+    """
+    n = len(equivalence_classes)
+    lengths = np.fromiter(
+        (len(x.umi) for x in equivalence_classes), dtype=np.int64, count=n
+    )
+    umi_length = lengths.max()
+    if (lengths == umi_length).all():
+        slots = None
+        umis = b''.join(x.umi for x in equivalence_classes)
+    else:
+        # pad shorter UMIs, the padding being masked out by their slots
+        # when comparing
+        slots = pack_lengths(lengths, umi_length)
+        umis = b''.join(x.umi.ljust(umi_length, b'A')
+                        for x in equivalence_classes)
+    # UMI sequences packed in 64-bit words
+    umis = pack_umis(
+        np.frombuffer(umis, dtype=np.uint8).reshape(n, umi_length)
+    )
+    counts = np.fromiter(
+        (x.count for x in equivalence_classes), dtype=np.int64, count=n
+    )
+    ft_bitmaps = pack_features([x.features for x in equivalence_classes])
+    # sort nodes by ascending read count: a node can only be connected to
+    # nodes having at most (count+1)//2 reads, i.e. to the nodes before
+    # its limit in this order.
+    order = np.argsort(counts, kind='stable')
+    counts = counts[order]
+    umis = umis[order]
+    if slots is not None:
+        slots = slots[order]
+    ft_bitmaps = ft_bitmaps[order]
+    limits = np.searchsorted(counts, (counts + 1) // 2, side='right')
+    sources = []
+    targets = []
+    step = max(1, BLOCK_ELEMENTS // n)
+    # nodes with a single read come first and are the only ones that can be
+    # connected in both directions: compare them once per unordered pair,
+    # then add both edges.
+    n_ones = np.searchsorted(counts, 1, side='right')
+    for start in range(0, n_ones, step):
+        end = min(start + step, n_ones)
+        block = slice(start, end)
+        rows, cols = np.nonzero(
+            (block_hamming(umis, slots, block, slice(start, n_ones))
+             <= threshold)
+            & overlap(ft_bitmaps[start:end, None],
+                      ft_bitmaps[None, start:n_ones])
+        )
+        rows += start
+        cols += start
+        # upper triangle, discarding self-loops
+        upper = rows < cols
+        rows = order[rows[upper]]
+        cols = order[cols[upper]]
+        sources += [rows, cols]
+        targets += [cols, rows]
+    # other nodes can only be connected to nodes with fewer reads, i.e.
+    # before them in this order.
+    for start in range(n_ones, n, step):
+        end = min(start + step, n)
+        # compare the block of nodes with the candidates of its last node
+        width = limits[end - 1]
+        if not width:
+            continue
+        block = slice(start, end)
+        rows, cols = np.nonzero(
+            (counts[start:end, None] >= 2 * counts[None, :width] - 1)
+            & (block_hamming(umis, slots, block, slice(0, width))
+               <= threshold)
+            & overlap(ft_bitmaps[start:end, None], ft_bitmaps[None, :width])
+        )
+        rows += start
+        sources.append(order[rows])
+        targets.append(order[cols])
+    if not sources:
+        return to_csr(n, np.empty(0, dtype=np.int64),
+                      np.empty(0, dtype=np.int64))
+    return to_csr(n, np.concatenate(sources), np.concatenate(targets))
+
+def to_csr(n, sources, targets):
+    """
+    Convert a list of directed edges to Compressed Sparse Row format.
+
+    Parameters
+    ----------
+    n : int
+        Number of nodes.
+    sources, targets : array
+        Nodes at the ends of each edge.
+
+    Returns
+    -------
+    indptr : array
+        Successors of node i are indices[indptr[i]:indptr[i+1]].
+    indices : array
+        Successors of each node, in ascending order.
+    """
+    indices = targets[np.lexsort((targets, sources))]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+    return indptr, indices
+
+def union_find(n, sources, targets):
+    """
+    Label the connected components of an undirected graph.
+
+    Disjoint-set union vectorized over the edge list: the root with the
+    larger index of each edge is hooked under the smaller one, then paths are
+    compressed by pointer jumping, until all edges join nodes with the same
+    root.
+
+    Parameters
+    ----------
+    n : int
+        Number of nodes.
+    sources, targets : array
+        Nodes at the ends of each edge.
+
+    Returns
+    -------
+    out : array
+        Root of each node, i.e. the smallest node index in its component.
+    """
+    roots = np.arange(n)
+    while True:
+        source_roots = roots[sources]
+        target_roots = roots[targets]
+        split = source_roots != target_roots
+        if not split.any():
+            return roots
+        source_roots = source_roots[split]
+        target_roots = target_roots[split]
+        np.minimum.at(
+            roots,
+            np.maximum(source_roots, target_roots),
+            np.minimum(source_roots, target_roots)
+        )
+        # path compression
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+
+def connected_components(indptr, indices):
+    """
+    Find the connected components of a graph in CSR format, regardless of
+    the direction of edges.
+
+    Returns
+    -------
+    out : list
+        Arrays of nodes of each component in ascending order, sorted by
+        their smallest node.
+    """
+    n = len(indptr) - 1
+    sources = np.repeat(np.arange(n), np.diff(indptr))
+    roots = union_find(n, sources, indices)
+    order = np.argsort(roots, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(roots[order])) + 1)
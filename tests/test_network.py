@@ -0,0 +1,23 @@
+from irescue.count import EquivalenceClass
+from irescue.network import build_graph
+
+
+def make_ecs(umis, counts):
+    return [EquivalenceClass(i, umi, {1}, count)
+            for i, (umi, count) in enumerate(zip(umis, counts))]
+
+
+def test_build_graph_mixed_umi_lengths():
+    # UMIs of different lengths are compared on their shared prefix only
+    ecs = make_ecs([b'ACGTACGTAC', b'ACGTACGTACGG', b'ACGTACGTA'], [3, 1, 1])
+    indptr, indices = build_graph(ecs, threshold=1)
+    assert indptr.tolist() == [0, 2, 3, 4]
+    assert indices.tolist() == [1, 2, 2, 1]
+    # one mismatch in the shared prefix
+    ecs = make_ecs([b'ACGTACGTAC', b'ACGTACGTTCG'], [3, 1])
+    indptr, indices = build_graph(ecs, threshold=1)
+    assert indices.tolist() == [1]
+    # two mismatches in the shared prefix
+    ecs = make_ecs([b'ACGTACGTAC', b'ACGTACGGTCG'], [3, 1])
+    indptr, indices = build_graph(ecs, threshold=1)
+    assert indices.tolist() == []